@@ -150,6 +150,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 document.getElementById('vlookup_sales_col').value = currentRule.vlookup_sales_col || '';
                 document.getElementById('vlookup_dest_col').value = currentRule.vlookup_dest_col || '';
                 document.getElementById('vlookup_value_col').value = currentRule.vlookup_value_col || '';
+                document.getElementById('vlookup_fuzzy_threshold').value = currentRule.fuzzy_threshold ?? '';
 
             } else if (type === 'new_bank') {
                 modalTitle.textContent = 'Add New Bank Rule';
@@ -259,6 +260,7 @@ document.addEventListener('DOMContentLoaded', function() {
     setupEditSaveButton('sales');
     setupEditSaveButton('advances');
     setupEditSaveButton('banking');
+    setupEditSaveButton('final');
 
     // --- INIT ---
     setActiveTabOnLoad();
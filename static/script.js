@@ -241,6 +241,73 @@ document.addEventListener('DOMContentLoaded', function () {
         }
     }
 
+    // Output format picked next to a process button (xlsx when there is no picker)
+    function selectedOutputFormat(selectId) {
+        const select = document.getElementById(selectId);
+        return select ? select.value : 'xlsx';
+    }
+
+    // Runs a processing step as a background job: submit, follow its stage events,
+    // then resolve with the download response (or throw the job's error).
+    const JOB_POLL_MS = 1000;
+    // Share of the bar reached at each pipeline stage
+    const JOB_STAGE_PROGRESS = {
+        queued: 5, started: 10, loaded: 35, renamed: 50, merged: 65,
+        writing: 80, written: 90, saved: 95, done: 100, failed: 100
+    };
+
+    function showJobProgress(event) {
+        if (!progressOverlay) { return; }
+        clearInterval(progressInterval);
+        const width = Math.max(parseFloat(progressBar.style.width) || 0, JOB_STAGE_PROGRESS[event.stage] || 0);
+        progressBar.style.width = width + '%';
+        progressText.innerText = event.message + ' (' + event.elapsed.toFixed(1) + 's)';
+    }
+
+    function fetchJob(url) {
+        return fetch(url).then(response => response.json().then(job => {
+            if (!response.ok) { throw new Error(job.error); }
+            return job;
+        }));
+    }
+
+    // Resolves once the job's event stream reports a final stage (or cannot be followed)
+    function followJobEvents(job) {
+        return new Promise(resolve => {
+            if (!window.EventSource) { resolve(); return; }
+            const events = new EventSource(job.events_url);
+            events.onmessage = function (e) {
+                const event = JSON.parse(e.data);
+                showJobProgress(event);
+                if (event.stage === 'done' || event.stage === 'failed') {
+                    events.close();
+                    resolve();
+                }
+            };
+            // Each response carries the events so far and ends; the browser reconnects
+            // after the retry hint. Only a closed source (finished job, 404) stops following
+            events.onerror = function () {
+                if (events.readyState === EventSource.CLOSED) { resolve(); }
+            };
+        });
+    }
+
+    function runJob(kind, formData) {
+        return fetch('/api/jobs/' + kind, { method: 'POST', body: formData })
+            .then(response => response.json().then(job => {
+                if (!response.ok) { throw new Error(job.error); }
+                return job;
+            }))
+            .then(job => followJobEvents(job).then(() => fetchJob(job.status_url)))
+            .then(function poll(job) {
+                if (job.status === 'done') { return fetch(job.download_url); }
+                if (job.status === 'failed') { throw new Error(job.error); }
+                return new Promise(resolve => setTimeout(resolve, JOB_POLL_MS))
+                    .then(() => fetchJob(job.status_url))
+                    .then(poll);
+            });
+    }
+
     // --- SALES PROCESSING (TAB 1) ---
     const salesButton = document.getElementById('btn-process-sales');
     const salesFile = document.getElementById('file-sales');
@@ -251,12 +318,14 @@ document.addEventListener('DOMContentLoaded', function () {
                 alert('Please select a Sales file to process.');
                 return;
             }
+            const outputFormat = selectedOutputFormat('format-sales');
             const formData = new FormData();
             formData.append('sales_file', file);
+            formData.append('output_format', outputFormat);
 
             startProgress();
 
-            fetch('/process-sales', { method: 'POST', body: formData })
+            runJob('sales', formData)
                 .then(response => {
                     if (response.ok) { return response.blob(); }
                     return response.json().then(errorData => { throw new Error(errorData.error); });
@@ -268,7 +337,7 @@ document.addEventListener('DOMContentLoaded', function () {
                     const a = document.createElement('a');
                     a.style.display = 'none';
                     a.href = url;
-                    a.download = 'Processed_Sales.xlsx';
+                    a.download = 'Processed_Sales.' + outputFormat;
                     document.body.appendChild(a);
                     a.click();
                     window.URL.revokeObjectURL(url);
@@ -297,7 +366,7 @@ document.addEventListener('DOMContentLoaded', function () {
 
             startProgress();
 
-            fetch('/process-advances', { method: 'POST', body: formData })
+            runJob('advances', formData)
                 .then(response => {
                     if (response.ok) { return response.blob(); }
                     return response.json().then(errorData => { throw new Error(errorData.error); });
@@ -373,9 +442,12 @@ document.addEventListener('DOMContentLoaded', function () {
                 return;
             }
 
+            const outputFormat = selectedOutputFormat('format-banking');
+            formData.append('output_format', outputFormat);
+
             startProgress();
 
-            fetch('/process-banking', { method: 'POST', body: formData })
+            runJob('banking', formData)
                 .then(response => {
                     if (response.ok) { return response.blob(); }
                     return response.json().then(errorData => { throw new Error(errorData.error); });
@@ -387,7 +459,7 @@ document.addEventListener('DOMContentLoaded', function () {
                     const a = document.createElement('a');
                     a.style.display = 'none';
                     a.href = url;
-                    a.download = 'Processed_Collection.xlsx';
+                    a.download = 'Processed_Collection.' + outputFormat;
                     document.body.appendChild(a);
                     a.click();
                     window.URL.revokeObjectURL(url);
@@ -424,7 +496,7 @@ document.addEventListener('DOMContentLoaded', function () {
 
             startProgress();
 
-            fetch('/process-individual-combine', { method: 'POST', body: formData })
+            runJob('individual', formData)
                 .then(response => {
                     if (response.ok) { return response.blob(); }
                     return response.json().then(errorData => { throw new Error(errorData.error); });
@@ -476,7 +548,7 @@ document.addEventListener('DOMContentLoaded', function () {
 
             startProgress();
 
-            fetch('/process-final-step', { method: 'POST', body: formData })
+            runJob('final-step', formData)
                 .then(response => {
                     if (response.ok) { return response.blob(); }
                     return response.json().then(errorData => { throw new Error(errorData.error); });
@@ -525,9 +597,11 @@ document.addEventListener('DOMContentLoaded', function () {
             for (let i = 0; i < combineOnlyInput.files.length; i++) {
                 formData.append('combine_mis', combineOnlyInput.files[i]);
             }
+            const outputFormat = selectedOutputFormat('format-combine-only');
+            formData.append('output_format', outputFormat);
 
             startProgress();
-            fetch('/process-combine-only', { method: 'POST', body: formData })
+            runJob('combine', formData)
                 .then(response => {
                     if (response.ok) { return response.blob(); }
                     return response.json().then(errorData => { throw new Error(errorData.error); });
@@ -539,7 +613,7 @@ document.addEventListener('DOMContentLoaded', function () {
                     const a = document.createElement('a');
                     a.style.display = 'none';
                     a.href = url;
-                    a.download = 'Processed_Combine_MIS.xlsx';
+                    a.download = 'Processed_Combine_MIS.' + outputFormat;
                     document.body.appendChild(a);
                     a.click();
                     window.URL.revokeObjectURL(url);
@@ -606,7 +680,7 @@ document.addEventListener('DOMContentLoaded', function () {
             formData.append('final_mis', finalOnlyInput.files[0]);
 
             startProgress();
-            fetch('/process-final-only', { method: 'POST', body: formData })
+            runJob('final', formData)
                 .then(response => {
                     if (response.ok) { return response.blob(); }
                     return response.json().then(errorData => { throw new Error(errorData.error); });
@@ -13,8 +13,19 @@ import pandas as pd
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+# Parsed uploads are cached in a throwaway folder (pool workers read it from the
+# environment), so runs never share cache entries or leave any in temp_uploads
+parse_cache_dir = tempfile.TemporaryDirectory()
+os.environ['PARSE_CACHE_FOLDER'] = parse_cache_dir.name
+
 from app import load_file_smartly
 
+# Pool workers (forkserver/spawn) re-import the main module; this script runs its checks
+# at import time, so point them at the app module instead
+if __name__ == '__main__':
+    import importlib.util
+    sys.modules['__main__'].__spec__ = importlib.util.find_spec('app')
+
 print("=" * 70)
 print("TESTING FILE LOADING FUNCTION")
 print("=" * 70)
@@ -98,6 +109,834 @@ try:
 except ImportError:
     print(f"   ⚠ xlrd not available, skipping XLS test")
 
+# Test 4: Mislabelled uploads are detected from content, not extension
+print("\n4. Testing content sniffing for mislabelled files...")
+try:
+    from app import sniff_file_format
+    mock_file = MockFileStorage(xlsx_bytes.getvalue(), 'statement.csv')
+    assert sniff_file_format(mock_file) == 'xlsx', "XLSX bytes named .csv not detected"
+    df = load_file_smartly(mock_file, sheet_name=None, start_row=1)
+    assert df.shape == (2, 3), f"Expected (2, 3), got {df.shape}"
+
+    mock_file = MockFileStorage(csv_content.getvalue(), 'statement.xls')
+    assert sniff_file_format(mock_file) == 'csv', "CSV bytes named .xls not detected"
+    df = load_file_smartly(mock_file, sheet_name='Sheet1', start_row=1)
+    assert df.shape == (2, 3), f"Expected (2, 3), got {df.shape}"
+    print("   ✓ Mislabelled XLSX/CSV detected and loaded in one pass")
+except Exception as e:
+    print(f"   ✗ Content sniffing failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 5: Chunked CSV streaming into the incremental writers
+print("\n5. Testing chunked CSV streaming...")
+try:
+    from app import iter_csv_chunks, StreamingExcelWriter, StreamingParquetWriter
+    rows = ['Store Code,Date,Amount'] + [f'S{i:03d},2025-11-01,{i}' for i in range(25)]
+    mock_file = MockFileStorage('\n'.join(rows).encode('utf-8'), 'big.csv')
+    chunks = list(iter_csv_chunks(mock_file, start_row=1, chunksize=10))
+    assert [len(c) for c in chunks] == [10, 10, 5], f"Unexpected chunk sizes {[len(c) for c in chunks]}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for writer_cls, ext in ((StreamingExcelWriter, 'xlsx'), (StreamingParquetWriter, 'parquet')):
+            path = os.path.join(tmp, f'out.{ext}')
+            writer = writer_cls(path, ['Store Code', 'Date', 'Amount'])
+            for chunk in iter_csv_chunks(mock_file, start_row=1, chunksize=10):
+                writer.append(chunk)
+            writer.close()
+            out = pd.read_parquet(path) if ext == 'parquet' else pd.read_excel(path, dtype=str)
+            assert out.shape == (25, 3), f"{ext}: expected (25, 3), got {out.shape}"
+            assert out['Store Code'].iloc[-1] == 'S024', f"{ext}: last row mismatch"
+
+    import app as app_module
+    from types import SimpleNamespace
+    from app import stream_sales_csv, QUIET_LOGGER
+    rule = SimpleNamespace(start_row=1, copy_col_source=None, copy_col_dest=None, bp_remove_cols=None,
+                           prefix_remove_col=None, prefix_remove_values=None)
+    rows = ['Store Code,Bill Date,Amount'] + [f'S{i:03d},{i % 28 + 1:02d}-02-2025,{i}' for i in range(25)]
+    rows[4] = rows[24] = 'S999,not a date,0'  # unreadable dates in the first and last chunks
+    sales_file = MockFileStorage('\n'.join(rows).encode('utf-8'), 'sales.csv')
+    import logging
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.messages = []
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+    stream_logger, captured = logging.getLogger('test.sales_stream'), ListHandler()
+    stream_logger.addHandler(captured)
+    stream_logger.propagate = False
+    mappings = {'StoreCode': 'Store Code', 'BillDate': 'Bill Date', 'Amount': 'Amount'}
+    columns = ['StoreCode', 'BillDate', 'Amount']
+    original_rows, original_infer, original_transform = (app_module.CSV_CHUNK_ROWS, app_module.infer_date_format,
+                                                         app_module.transform_sales_frame)
+    inferred = []
+    app_module.CSV_CHUNK_ROWS = 10
+    app_module.infer_date_format = lambda *a, **k: inferred.append(1) or original_infer(*a, **k)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sales.csv')
+            read, written, sidecar = stream_sales_csv(sales_file, rule, mappings, columns, path, 'csv', None, stream_logger)
+            assert (read, written, len(inferred)) == (25, 25, 1), f"read {read}, wrote {written}, inferred {len(inferred)}x"
+            dates = pd.read_parquet(sidecar)['BillDate']
+            assert dates.dropna().dt.month.eq(2).all() and dates.iloc[-1].day == 25, "BillDate read inconsistently"
+            failures = [m for m in captured.messages if 'could not be read as dates' in m]
+            assert failures == ["Col 'BillDate': 2 value(s) could not be read as dates"], failures
+
+            def failing(chunk, *args, **kwargs):
+                if chunk['Store Code'].iloc[0] == 'S020':
+                    raise ValueError("bad chunk")
+                return original_transform(chunk, *args, **kwargs)
+            app_module.transform_sales_frame = failing
+            for output_format in ('xlsx', 'csv'):
+                path = os.path.join(tmp, f'failed.{output_format}')
+                try:
+                    stream_sales_csv(sales_file, rule, mappings, columns, path, output_format, None, QUIET_LOGGER)
+                    raise AssertionError("Stream did not fail")
+                except ValueError:
+                    pass
+                assert not os.path.exists(path), f"Partial {output_format} output left behind"
+                assert not os.path.exists(app_module.parquet_sidecar_path(path)), "Partial sidecar left behind"
+    finally:
+        app_module.CSV_CHUNK_ROWS, app_module.infer_date_format = original_rows, original_infer
+        app_module.transform_sales_frame = original_transform
+    print("   ✓ CSV streamed in 3 chunks and written incrementally to XLSX and Parquet")
+    print("   ✓ Sales stream infers BillDate once and removes partial outputs on failure")
+except Exception as e:
+    print(f"   ✗ Chunked streaming failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 6: Re-uploading the same bytes is served from the Parquet parse cache
+print("\n6. Testing content-hash parse cache...")
+try:
+    import app as app_module
+    with tempfile.TemporaryDirectory() as tmp:
+        original_folder = app_module.PARSE_CACHE_FOLDER
+        app_module.PARSE_CACHE_FOLDER = tmp
+        try:
+            first = load_file_smartly(MockFileStorage(xlsx_bytes.getvalue(), 'a.xlsx'), sheet_name=None, start_row=1)
+            assert len(os.listdir(tmp)) == 1, "Parsed upload was not cached"
+            second = load_file_smartly(MockFileStorage(xlsx_bytes.getvalue(), 'b.xlsx'), sheet_name=None, start_row=1)
+            assert first.equals(second), "Cached parse differs from the original"
+            load_file_smartly(MockFileStorage(xlsx_bytes.getvalue(), 'a.xlsx'), sheet_name=None, start_row=2)
+            assert len(os.listdir(tmp)) == 2, "Different header row should be cached separately"
+            app_module.prune_parse_cache(max_bytes=0)
+            assert os.listdir(tmp) == [], "LRU eviction did not empty the cache"
+
+            # An entry another request evicts mid-scan is skipped, and cache upkeep never
+            # fails the upload it was written for
+            class EvictedEntry:
+                name, path = 'evicted.parquet', os.path.join(tmp, 'evicted.parquet')
+                def is_file(self):
+                    return True
+                def stat(self):
+                    raise FileNotFoundError(self.path)
+            original_scandir = app_module.os.scandir
+            app_module.os.scandir = lambda path: [EvictedEntry()] + list(original_scandir(path))
+            try:
+                app_module.prune_parse_cache(max_bytes=0)
+                df = load_file_smartly(MockFileStorage(xlsx_bytes.getvalue(), 'c.xlsx'), sheet_name=None, start_row=1)
+                assert df.shape == (2, 3), f"Expected (2, 3), got {df.shape}"
+                app_module.os.scandir = lambda path: (_ for _ in ()).throw(PermissionError(path))
+                df = load_file_smartly(MockFileStorage(csv_content.getvalue(), 'c.csv'), sheet_name='Sheet1', start_row=1)
+                assert df.shape == (2, 3), "Failed cache upkeep failed the upload"
+            finally:
+                app_module.os.scandir = original_scandir
+        finally:
+            app_module.PARSE_CACHE_FOLDER = original_folder
+    print("   ✓ Same bytes loaded from cache; entries keyed by header row and evicted by size")
+    print("   ✓ Entries evicted mid-scan skipped; cache upkeep errors never fail a load")
+except Exception as e:
+    print(f"   ✗ Parse cache failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 7: CSV encoding is detected once from a sample
+print("\n7. Testing CSV charset detection...")
+try:
+    from app import detect_text_encoding
+    text = 'Store Code,Store Name,Amount\nS001,Café – Nörth,1000\n'
+    for encoding, expected in (('utf-8', 'utf-8'), ('cp1252', 'cp1252'), ('utf-8-sig', 'utf-8-sig')):
+        mock_file = MockFileStorage(text.encode(encoding), 'stores.csv')
+        detected, confidence, method = detect_text_encoding(mock_file)
+        assert detected == expected, f"{encoding}: detected {detected} via {method}"
+        df = load_file_smartly(mock_file, sheet_name=None, start_row=1)
+        assert df['Store Name'].iloc[0] == 'Café – Nörth', f"{encoding}: decoded {df['Store Name'].iloc[0]!r}"
+    print("   ✓ UTF-8, cp1252 and BOM-prefixed CSVs detected and decoded in one parse")
+
+    # cp1252 bytes only outside the sampled windows: re-read as cp1252, not replaced
+    rows = ['Store Code,StoreName,BillDate,Amount'] + [f'S{i:05d},Plain Store,01-11-2025,{i}' for i in range(12000)]
+    rows[3000] = 'S99999,Café € Nörth,01-11-2025,1'
+    late_cp1252 = '\n'.join(rows).encode('cp1252')
+    assert detect_text_encoding(MockFileStorage(late_cp1252, 'late.csv'))[0] == 'utf-8', "Fixture not sampled as UTF-8"
+    df = load_file_smartly(MockFileStorage(late_cp1252, 'late.csv'), sheet_name=None, start_row=1)
+    assert df['StoreName'].iloc[2999] == 'Café € Nörth', f"Decoded {df['StoreName'].iloc[2999]!r}"
+    rule = SimpleNamespace(start_row=1, copy_col_source=None, copy_col_dest=None, bp_remove_cols=None,
+                           prefix_remove_col=None, prefix_remove_values=None)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'sales.csv')
+        stream_sales_csv(MockFileStorage(late_cp1252, 'late.csv'), rule, {}, ['StoreName', 'BillDate', 'Amount'],
+                         path, 'csv', None, QUIET_LOGGER)
+        assert pd.read_csv(path, dtype=str)['StoreName'].iloc[2999] == 'Café € Nörth', "Stream replaced cp1252 bytes"
+    print("   ✓ Undecodable bytes beyond the sample re-read as cp1252 by the loader and the Sales stream")
+except Exception as e:
+    print(f"   ✗ Charset detection failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 8: Sheet names and headers are read without loading whole sheets
+print("\n8. Testing lightweight workbook inspection...")
+try:
+    from app import inspect_workbook
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Summary'
+    ws.append(['Title only'])
+    ws = wb.create_sheet('MIS Working')
+    ws.append(['Report'])
+    ws.append([])
+    ws.append(['Store Code', None, 'Amount', 'Amount', datetime(2025, 11, 1), 2025])
+    ws.append(['S001', 'x', 1, 2, 3, 4])
+    inspect_bytes = io.BytesIO()
+    wb.save(inspect_bytes)
+
+    for header_row in (0, 2):
+        expected = {}
+        xls = pd.ExcelFile(io.BytesIO(inspect_bytes.getvalue()), engine='openpyxl')
+        for name in xls.sheet_names:
+            try:
+                expected[name] = [str(c) for c in pd.read_excel(xls, sheet_name=name, header=header_row, nrows=0).columns]
+            except Exception:
+                expected[name] = []
+        got = inspect_workbook(MockFileStorage(inspect_bytes.getvalue(), 'mis.xlsx'), header_row=header_row)
+        assert got == expected, f"header_row={header_row}: {got} != {expected}"
+    print("   ✓ Sheet names and header labels match pandas without parsing the sheets")
+except Exception as e:
+    print(f"   ✗ Workbook inspection failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 9: Combine MIS uploads parsed in a process pool keep upload order and per-file errors
+print("\n9. Testing parallel Combine MIS loading...")
+try:
+    from app import load_combine_uploads
+    uploads = []
+    for region in ('North', 'South', 'East'):
+        wb = Workbook()
+        ws = wb.active
+        ws.title = 'MIS Working'
+        ws.append([f'{region} MIS'])
+        ws.append([])
+        ws.append(['Store Code', 'Region'])
+        ws.append([f'{region[0]}001', region])
+        buf = io.BytesIO()
+        wb.save(buf)
+        uploads.append(MockFileStorage(buf.getvalue(), f'{region}.xlsx'))
+    uploads.insert(1, MockFileStorage(b'PK\x03\x04not a workbook', 'broken.xlsx'))
+
+    results = load_combine_uploads(uploads, 'smart', workers=2)
+    assert [name for name, _, _ in results] == ['North.xlsx', 'broken.xlsx', 'South.xlsx', 'East.xlsx']
+    assert results[1][2] is not None and results[1][1] is None, "Broken file should report its error"
+    regions = [df['Region'].iloc[0] for _, df, error in results if error is None]
+    assert regions == ['North', 'South', 'East'], f"Unexpected order {regions}"
+    print("   ✓ Files parsed in a pool, returned in upload order with per-file errors")
+except Exception as e:
+    print(f"   ✗ Parallel loading failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 10: Columnar XLSX writer keeps values and applies column formats
+print("\n10. Testing direct formatted XLSX writer...")
+try:
+    from app import write_formatted_workbook
+    from openpyxl import load_workbook
+    frame = pd.DataFrame({
+        'Store Code': ['S001', 'S002', None],
+        'BillDate': pd.to_datetime(['2025-11-01', None, '2025-11-03']),
+        'Amount': [1000.5, float('nan'), 3000],
+        'Remarks': ['', '', ''],
+    })
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'out.xlsx')
+        write_formatted_workbook(path, {'Sheet1': frame})
+        out = pd.read_excel(path)
+        assert out['Store Code'].tolist()[:2] == ['S001', 'S002'] and pd.isna(out['Store Code'].iloc[2])
+        assert out['BillDate'].iloc[0] == pd.Timestamp('2025-11-01') and pd.isna(out['BillDate'].iloc[1])
+        assert out['Amount'].iloc[0] == 1000.5 and pd.isna(out['Amount'].iloc[1])
+        ws = load_workbook(path).active
+        assert ws['B2'].number_format == 'dd-mm-yyyy', f"Date format {ws['B2'].number_format}"
+        assert ws.column_dimensions['D'].fill.fgColor.rgb.endswith('000000'), "Empty column not black-filled"
+    print("   ✓ Values round-trip; date format and empty-column fill applied")
+except Exception as e:
+    print(f"   ✗ Formatted writer failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 11: Large outputs switch to the constant-memory writer with the same formatting
+print("\n11. Testing automatic streaming export above the row threshold...")
+try:
+    import app as app_module
+    from app import save_with_formatting
+    with tempfile.TemporaryDirectory() as tmp:
+        in_memory, streamed = os.path.join(tmp, 'a.xlsx'), os.path.join(tmp, 'b.xlsx')
+        save_with_formatting(frame, in_memory)
+        original_threshold = app_module.EXCEL_STREAMING_ROW_THRESHOLD
+        app_module.EXCEL_STREAMING_ROW_THRESHOLD = 1
+        try:
+            save_with_formatting(frame, streamed)
+        finally:
+            app_module.EXCEL_STREAMING_ROW_THRESHOLD = original_threshold
+        pd.testing.assert_frame_equal(pd.read_excel(in_memory), pd.read_excel(streamed))
+        ws = load_workbook(streamed).active
+        assert ws['B2'].number_format == 'dd-mm-yyyy', f"Date format {ws['B2'].number_format}"
+        assert ws.column_dimensions['D'].fill.fgColor.rgb.endswith('000000'), "Empty column not black-filled"
+    print("   ✓ Streamed workbook matches the in-memory one, formats included")
+except Exception as e:
+    print(f"   ✗ Streaming export failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 12: Processed files are served from disk with Range support
+print("\n12. Testing disk-backed downloads...")
+try:
+    from app import app as flask_app, send_processed_file
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'out.xlsx')
+        save_with_formatting(frame, path)
+        size = os.path.getsize(path)
+        with flask_app.test_request_context('/', headers={'Range': 'bytes=0-9'}):
+            response = send_processed_file(path, 'Processed.xlsx')
+            response.direct_passthrough = False
+            assert response.status_code == 206, f"Expected 206, got {response.status_code}"
+            assert response.headers['Content-Range'] == f'bytes 0-9/{size}'
+            with open(path, 'rb') as f:
+                assert response.get_data() == f.read(10), "Range body mismatch"
+            response.close()
+    print("   ✓ Partial content served straight from the saved file")
+except Exception as e:
+    print(f"   ✗ Disk-backed download failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 13: CSV / Parquet outputs read back like the XLSX version
+print("\n13. Testing CSV and Parquet output modes...")
+try:
+    from app import save_output, load_processed_table, StreamingCsvWriter
+    typed = pd.DataFrame({
+        'Store Code': ['S001', 'S002'],
+        'Date': pd.to_datetime(['2025-11-01', '2025-11-02']),
+        'Amount': [1000.0, 2500.5],
+        'Mixed': [5, 'text'],
+    })
+    with tempfile.TemporaryDirectory() as tmp:
+        as_text = {}
+        for fmt in ('xlsx', 'csv', 'parquet'):
+            path = os.path.join(tmp, f'out.{fmt}')
+            assert save_output(typed, path, fmt), f"{fmt}: save failed"
+            as_text[fmt] = load_processed_table(path, dtype=str)
+        pd.testing.assert_frame_equal(as_text['xlsx'], as_text['parquet'])
+        assert as_text['csv']['Store Code'].tolist() == ['S001', 'S002']
+        assert load_processed_table(os.path.join(tmp, 'out.csv'))['Date'].iloc[1] == pd.Timestamp('2025-11-02')
+
+        path = os.path.join(tmp, 'chunks.csv')
+        writer = StreamingCsvWriter(path, list(typed.columns))
+        writer.append(typed.iloc[:1])
+        writer.append(typed.iloc[1:])
+        writer.close()
+        assert pd.read_csv(path).shape == (2, 4), "Chunked CSV rows missing"
+    print("   ✓ Parquet reads back as the XLSX text values; CSV keeps dates and chunks")
+except Exception as e:
+    print(f"   ✗ Output modes failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 14: ZIP archives are streamed member by member without recompression
+print("\n14. Testing streaming ZIP output...")
+try:
+    import zipfile
+    from app import iter_zip_stream
+    with tempfile.TemporaryDirectory() as tmp:
+        def members():
+            for i, region in enumerate(('North', 'South')):
+                path = os.path.join(tmp, f'{i}.xlsx')
+                save_with_formatting(frame.assign(Region=region), path)
+                yield f'{region}.xlsx', path
+
+        pieces = list(iter_zip_stream(members()))
+        assert len([p for p in pieces if p]) > 2, "Archive was not produced incrementally"
+        assert os.listdir(tmp) == [], "Member temp files were not removed"
+        with zipfile.ZipFile(io.BytesIO(b''.join(pieces))) as zf:
+            assert zf.testzip() is None, "Corrupt member"
+            assert [i.filename for i in zf.infolist()] == ['North.xlsx', 'South.xlsx']
+            assert all(i.compress_type == zipfile.ZIP_STORED for i in zf.infolist()), "Members recompressed"
+            assert pd.read_excel(io.BytesIO(zf.read('South.xlsx')))['Region'].iloc[0] == 'South'
+    print("   ✓ Members stored and streamed as they are produced")
+except Exception as e:
+    print(f"   ✗ Streaming ZIP failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 15: Split partitions come from one groupby pass and are written in a pool
+print("\n15. Testing group-by split with pooled writers...")
+try:
+    from app import split_partitions, iter_split_files
+    spoc = pd.DataFrame({
+        'AMVIAK SPOC': ['B/1', 'A', 'B1', None, 'A', ' ', 'b1'],
+        'Amount': ['1', '2', '3', '4', '5', '6', '7'],
+    })
+    parts = list(split_partitions(spoc, 'AMVIAK SPOC'))
+    assert [name for name, _ in parts] == ['B1', 'A', 'B1 (2)', 'b1 (3)'], [name for name, _ in parts]
+    assert parts[1][1]['Amount'].tolist() == ['2', '5'], "Group rows out of order"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        written = {}
+        for workers in (1, 2):
+            workdir = os.path.join(tmp, str(workers))
+            os.makedirs(workdir)
+            written[workers] = [(arcname, pd.read_csv(path, dtype=str).to_dict('list'))
+                                for arcname, path in iter_split_files(split_partitions(spoc, 'AMVIAK SPOC'), 'csv', workdir, workers=workers)]
+        assert written[1] == written[2], "Pooled split differs from sequential split"
+        assert [arcname for arcname, _ in written[2]] == ['B1.csv', 'A.csv', 'B1 (2).csv', 'b1 (3).csv']
+
+    # CSV uploads go through load_file_smartly: a cp1252 export keeps its accents
+    import zipfile
+    upload = 'Store,AMVIAK SPOC,Amount\nS1,Chloé,1\nS2,Rahul,2\nS3,Chloé,3\n'.encode('cp1252')
+    flask_app.config['LOGIN_DISABLED'] = True
+    try:
+        response = flask_app.test_client().post('/process-split-file', data={
+            'split_file': (io.BytesIO(upload), 'spoc.csv'), 'split_column': 'AMVIAK SPOC', 'split_mode': 'csv'})
+        archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+    finally:
+        flask_app.config['LOGIN_DISABLED'] = False
+    assert archive.namelist() == ['Chloé.csv', 'Rahul.csv'], archive.namelist()
+    assert pd.read_csv(archive.open('Chloé.csv'), dtype=str)['Store'].tolist() == ['S1', 'S3']
+    print("   ✓ Groups in first-appearance order with unique names; pooled output matches")
+    print("   ✓ CSV split uploads decoded like every other upload")
+except Exception as e:
+    print(f"   ✗ Group-by split failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 16: Processed Sales keeps a Parquet copy that reads back like the workbook
+print("\n16. Testing Parquet sidecar for processed outputs...")
+try:
+    from app import write_parquet_sidecar, ParquetSidecarWriter
+    sales_out = pd.DataFrame({
+        'StoreName': ['Store 1', 'Store 2', ''],
+        'StoreCode': ['1001', '1002', ''],
+        'BillDate': pd.to_datetime(['2025-11-01', '2025-11-02', None]),
+    })
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'sales.xlsx')
+        save_with_formatting(sales_out, path)
+        sidecar = write_parquet_sidecar(sales_out, path)
+        assert sidecar == os.path.join(tmp, 'sales.parquet'), f"Unexpected sidecar {sidecar}"
+        pd.testing.assert_frame_equal(load_processed_table(path), load_processed_table(sidecar))
+        lookup = load_processed_table(sidecar, columns=['StoreName', 'StoreCode'])
+        assert list(lookup.columns) == ['StoreName', 'StoreCode'], "Projection ignored"
+
+        writer = ParquetSidecarWriter(os.path.join(tmp, 'chunked.parquet'), ['A'])
+        writer.append(pd.DataFrame({'A': [1, 2]}))
+        writer.append(pd.DataFrame({'A': ['not', 'an int']}))
+        assert writer.close() is None and not os.path.exists(os.path.join(tmp, 'chunked.parquet')), "Bad sidecar kept"
+    print("   ✓ Sidecar matches the workbook read-back; mismatched chunks abandon it")
+except Exception as e:
+    print(f"   ✗ Parquet sidecar failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 17: Step B reads only the keys and update columns from the Combine Parquet copy
+print("\n17. Testing Combine table projection for Step B...")
+try:
+    from app import load_combine_table, FINAL_UPDATE_COLUMNS
+    combine_out = pd.DataFrame({
+        ' Store Code': [1001, 1002],
+        'Date': pd.to_datetime(['2025-11-01', '2025-11-02']),
+        'HB-Card': [5.0, 2.5],
+        'Remarks': ['r1', None],
+        'Other': ['o', 'o'],
+    })
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'combine.xlsx')
+        save_with_formatting(combine_out, path)
+        df, store_col, date_col = load_combine_table(write_parquet_sidecar(combine_out, path), FINAL_UPDATE_COLUMNS)
+        assert (store_col, date_col) == ('Store Code', 'Date'), (store_col, date_col)
+        assert list(df.columns) == ['Store Code', 'Date', 'HB-Card', 'Remarks'], list(df.columns)
+        assert pd.api.types.is_datetime64_any_dtype(df['Date']), "Date key lost its type"
+        text = load_processed_table(path, dtype=str)
+        text.columns = text.columns.str.strip()
+        pd.testing.assert_frame_equal(df.drop(columns='Date'), text[['Store Code', 'HB-Card', 'Remarks']])
+    print("   ✓ Keys and update columns only; text matches the workbook read with dtype=str")
+except Exception as e:
+    print(f"   ✗ Combine table projection failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 18: A background job keeps the route's download as its result
+print("\n18. Testing background job results...")
+try:
+    from app import _save_job_response, JOB_ROUTES
+    assert {'sales', 'advances', 'banking', 'combine', 'final', 'split'} <= set(JOB_ROUTES), "Job kinds missing"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'out.csv')
+        frame.to_csv(path, index=False)
+        with flask_app.test_request_context('/'):
+            response = send_processed_file(path, 'Processed_Sales.csv')
+            result, download_name, mimetype = _save_job_response(response, tmp)
+        assert (os.path.basename(result), download_name, mimetype) == ('result.csv', 'Processed_Sales.csv', 'text/csv')
+        with open(path, 'rb') as a, open(result, 'rb') as b:
+            assert a.read() == b.read(), "Job result differs from the route's file"
+
+    import time
+    from datetime import timedelta
+    from app import ProcessingJob, job_is_stale, touch_job_heartbeat
+    original_folder = app_module.JOB_FOLDER
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            app_module.JOB_FOLDER = tmp
+            old = datetime.utcnow() - timedelta(seconds=app_module.JOB_STALE_SECONDS + 60)
+            job = ProcessingJob(id='stale-job', status='running', created_at=old, started_at=old)
+            assert job_is_stale(job), "Job without a heartbeat since long ago not stale"
+            os.makedirs(os.path.join(tmp, job.id))
+            touch_job_heartbeat(job.id)
+            assert not job_is_stale(job), "Job with a fresh heartbeat marked stale"
+            stamp = time.time() - app_module.JOB_STALE_SECONDS - 60
+            os.utime(app_module.job_heartbeat_path(job.id), (stamp, stamp))
+            assert job_is_stale(job), "Job whose heartbeat stopped not stale"
+    finally:
+        app_module.JOB_FOLDER = original_folder
+    print("   ✓ Route response saved with its download name and type; orphaned jobs detected")
+except Exception as e:
+    print(f"   ✗ Background job result failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 19: Job stage events stream as SSE and resume from the last event id
+print("\n19. Testing job progress events...")
+try:
+    import json
+    from app import JobEventLog, iter_job_events
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'events.jsonl')
+        events = JobEventLog(path)
+        events.emit('loaded', 'Loaded 3 rows', rows=3)
+        events.emit('written', bytes=2048)
+        with open(path, 'a', encoding='utf-8') as fh:
+            fh.write('{"stage": "merg')  # half-written line
+        messages = list(iter_job_events(path, retry_ms=750))
+        assert messages[0] == 'retry: 750\n\n', f"Missing reconnect hint: {messages[0]!r}"
+        data = [json.loads(m.split('data: ', 1)[1]) for m in messages if 'data: ' in m]
+        assert [(e['stage'], e.get('rows'), e.get('bytes')) for e in data] == [('loaded', 3, None), ('written', None, 2048)], data
+        assert all('elapsed' in e for e in data), "Events without elapsed time"
+        last_id = int(messages[-1].split('id: ', 1)[1].split('\n', 1)[0])
+        assert last_id == len(open(path, 'rb').read().rsplit(b'\n', 1)[0]) + 1, "Event id is not the byte offset"
+
+        with open(path, 'r+', encoding='utf-8') as fh:  # drop the half-written line
+            lines = [l for l in fh if l.endswith('\n')]
+            fh.seek(0); fh.truncate(); fh.writelines(lines)
+        events.emit('done', 'Finished')
+        resumed = [m for m in iter_job_events(path, offset=last_id) if 'data: ' in m]
+        assert len(resumed) == 1 and '"done"' in resumed[0], resumed
+        assert list(iter_job_events(os.path.join(tmp, 'missing.jsonl'))) == [f'retry: {app_module.JOB_EVENTS_RETRY_MS}\n\n']
+    print("   ✓ Complete events only, ids are offsets, each response ends with what is written so far")
+except Exception as e:
+    print(f"   ✗ Job progress events failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 20: Log tails are read from the end and by byte offset
+print("\n20. Testing incremental log tailing...")
+try:
+    from app import tail_lines, read_log_from
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'process.log')
+        with open(path, 'w', encoding='utf-8') as fh:
+            fh.writelines(f"line {i} ✓\n" for i in range(500))
+            fh.write("half a li")
+        lines, end = tail_lines(path, 3, block=16)
+        assert lines == ['line 497 ✓', 'line 498 ✓', 'line 499 ✓'], lines
+        assert end == os.path.getsize(path) - len("half a li"), "Offset includes the unfinished line"
+
+        text, start, next_offset = read_log_from(path, end)
+        assert (text, next_offset) == ('', end), "Unfinished line sent"
+        with open(path, 'a', encoding='utf-8') as fh:
+            fh.write("ne\nline 501 ✓\n")
+        text, start, next_offset = read_log_from(path, end)
+        assert text == "half a line\nline 501 ✓\n" and next_offset == os.path.getsize(path), repr(text)
+        assert read_log_from(path, next_offset + 100)[1] == 0, "Replaced log not re-read from the start"
+    print("   ✓ Last lines from a reverse seek; only appended complete lines after an offset")
+except Exception as e:
+    print(f"   ✗ Log tailing failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+# Test 21: Store Code + Date join keys are typed and shared by the Final MIS routes
+print("\n21. Testing typed match keys...")
+try:
+    from app import build_match_keys
+    final_keys, combine_keys = build_match_keys(
+        pd.Series(['1001', ' 1002', '1003', '1001']),
+        pd.Series(['2025-11-01', '2025-11-02', None, '2025-11-03']),
+        pd.Series([1001, '1002 ', '1003', '1001']),
+        pd.to_datetime(pd.Series(['2025-11-01 09:30', '2025-11-02 00:00', None, '2025-11-04 00:00'])))
+    assert final_keys.dtype == 'int64' and combine_keys.dtype == 'int64', "Keys are not int64"
+    assert list(final_keys[:3]) == list(combine_keys[:3]), "Same store and day did not match"
+    assert final_keys[3] not in set(combine_keys), "Different day matched"
+    assert len(set(final_keys)) == 4, "Distinct store/day pairs collided"
+    print("   ✓ Stripped store + day keys; time of day ignored, missing dates match on store")
+except Exception as e:
+    print(f"   ✗ Typed match keys failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+print("\n22. Testing single-pass column updates...")
+try:
+    from app import apply_column_updates
+    target = pd.DataFrame({'Store': ['A', 'B', 'C'], 'HB-Cash': ['1', '2', '3'], 'Remarks': ['x', 'y', 'z']})
+    source = pd.DataFrame({'Store': ['A', 'A', 'C'], 'HB-Cash': ['10', '99', None],
+                           'Remarks': ['ra', 'rb', 'rc'], 'Ad-CCN': ['5', '6', '7']})
+    columns = ['HB-Cash', 'Remarks', 'Ad-CCN', 'Ad-Bank Offer']
+    out, matched = apply_column_updates(target, target['Store'], source, source['Store'], columns)
+    assert list(out.columns) == ['Store', 'HB-Cash', 'Remarks'], f"Columns changed: {list(out.columns)}"
+    assert list(out['HB-Cash']) == ['10', '2', '3'], f"Wrong fill: {list(out['HB-Cash'])}"
+    assert list(out['Remarks']) == ['ra', 'y', 'rc'], f"Wrong fill: {list(out['Remarks'])}"
+    assert matched == 2, f"Expected 2 matched rows, got {matched}"
+    assert list(target['HB-Cash']) == ['1', '2', '3'], "Target frame was modified"
+    out, _ = apply_column_updates(target, target['Store'], source, source['Store'], columns, add_missing=True)
+    assert list(out.columns) == ['Store', 'HB-Cash', 'Remarks', 'Ad-CCN', 'Ad-Bank Offer'], f"Bad order: {list(out.columns)}"
+    assert list(out['Ad-CCN'].fillna('-')) == ['5', '-', '7'] and set(out['Ad-Bank Offer']) == {''}
+    print("   ✓ First source row wins, gaps keep target values, missing columns appended")
+except Exception as e:
+    print(f"   ✗ Column updates failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+print("\n23. Testing shared date engine...")
+try:
+    import datetime as dt
+    from app import parse_dates_with_failures
+    values = pd.Series(['01-11-2025', '13-11-2025', '45962', 45963.0, dt.datetime(2025, 11, 4),
+                        '2025-11-05 00:00:00', 'not a date', None, '', '01-11-2025'])
+    dates, failed = parse_dates_with_failures(values, dayfirst=True)
+    expected = ['2025-11-01', '2025-11-13', '2025-11-01', '2025-11-02', '2025-11-04',
+                '2025-11-05', None, None, None, '2025-11-01']
+    got = [d.strftime('%Y-%m-%d') if pd.notna(d) else None for d in dates]
+    assert got == expected, f"Unexpected dates: {got}"
+    assert failed == 1, f"Expected 1 unparseable value, got {failed}"
+    iso, _ = parse_dates_with_failures(pd.Series(['2025-11-01', '2025-11-12']), dayfirst=True)
+    assert list(iso.dt.month) == [11, 11], "ISO dates were read day-first"
+    print("   ✓ Serials, DD-MM-YYYY, ISO text and datetimes parsed together; 1 failure counted")
+except Exception as e:
+    print(f"   ✗ Date engine failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+print("\n24. Testing cached column type inference...")
+try:
+    import app as app_module
+    from app import convert_column_types, infer_column_types
+    sheet = pd.DataFrame({'Store Code': ['1001', '1002', '1003'], 'Bill Number': ['7', '8', '9'],
+                          'Amount Paid': ['1.5', None, 'n/a'], 'Date': ['01-11-2025', '2025-11-02', None],
+                          'Remarks': ['a', 'b', 'c']})
+    assert infer_column_types(sheet, keep_ids=True) == ['keep', 'number', 'keep', 'date', 'keep'], \
+        f"Unexpected lenient types: {infer_column_types(sheet, keep_ids=True)}"
+    assert infer_column_types(sheet, strict=True) == ['number', 'number', 'keep', 'date', 'keep'], \
+        f"Unexpected strict types: {infer_column_types(sheet, strict=True)}"
+    app_module._schema_cache.clear()
+    convert_column_types(sheet, keep_ids=True)
+    assert sheet['Store Code'].tolist() == ['1001', '1002', '1003'], "Identifier column converted"
+    assert sheet['Bill Number'].tolist() == [7, 8, 9], "Bill Number not numeric"
+    assert sheet['Date'].dt.day.tolist()[:2] == [1, 2], "Dates not parsed"
+    assert len(app_module._schema_cache) == 1, "Schema not cached"
+    # Same header layout: a stale cached schema never overrides what this sheet holds
+    app_module._schema_cache[next(iter(app_module._schema_cache))] = ['keep', 'keep', 'keep', 'keep', 'number']
+    again = pd.DataFrame({'Store Code': ['1'], 'Bill Number': ['2'], 'Amount Paid': ['3'], 'Date': [None], 'Remarks': ['4']})
+    convert_column_types(again, keep_ids=True)
+    assert again['Remarks'].tolist() == [4] and again['Bill Number'].tolist() == [2], "Stale cached schema used"
+    # A column too sparse to be numeric on the first sheet still converts when it fills up
+    sparse = convert_column_types(pd.DataFrame({'Store': list('abcdefghij'), 'Cash': ['5'] + [None] * 9}))
+    assert sparse['Cash'].tolist()[0] == '5', "Sparse column converted"
+    full = convert_column_types(pd.DataFrame({'Store': list('abcdefghij'), 'Cash': [str(i) for i in range(10)]}))
+    assert full['Cash'].tolist() == list(range(10)), f"Cached 'keep' left numbers as text: {full['Cash'].tolist()}"
+    # Same headers, different contents: a cached number column must not blank text
+    numeric_ref = convert_column_types(pd.DataFrame({'Ref': ['100', '200', '300']}))
+    assert numeric_ref['Ref'].tolist() == [100, 200, 300], "Numeric Ref not converted"
+    text_ref = convert_column_types(pd.DataFrame({'Ref': ['ABC', 'XYZ', 'QRS']}))
+    assert text_ref['Ref'].tolist() == ['ABC', 'XYZ', 'QRS'], f"Cached type blanked text: {text_ref['Ref'].tolist()}"
+    mixed = pd.DataFrame({'Value': ['1'] * 300 + ['x']})
+    convert_column_types(mixed, strict=True)
+    assert mixed['Value'].iloc[-1] == 'x', "Strict mode dropped a text value"
+    print("   ✓ Types inferred from each sheet's sample, stale cached types ignored, strict mode lossless")
+except Exception as e:
+    print(f"   ✗ Column type inference failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+print("\n25. Testing Advances store-name lookup...")
+try:
+    from app import match_lookup_keys, normalize_names
+    assert normalize_names(pd.Series(['  Phoenix  Mall, Pune. ', None, '--'])).tolist()[:1] == ['phoenix mall pune']
+    sales_names = pd.Series(['Store 1', ' Store 11 ', 'Phoenix Mall, Pune', 'Lulu Mall Kochi'])
+    advances_names = pd.Series(['Store 1', 'STORE 11.', 'phoenix mall pune', 'Phoenix Mall Pune 2',
+                                'Lulu Mall Kochl', None, 'Nowhere'])
+    positions, stats = match_lookup_keys(advances_names, sales_names, fuzzy_threshold=0.8)
+    assert positions.tolist() == [0, 1, 2, -1, 3, -1, -1], f"Unexpected matches: {positions.tolist()}"
+    assert stats == {'exact': 1, 'normalized': 2, 'fuzzy': 1, 'unmatched': 3}, f"Unexpected stats: {stats}"
+    positions, stats = match_lookup_keys(advances_names, sales_names)
+    assert positions[4] == -1 and stats['fuzzy'] == 0, "Fuzzy matching ran with threshold 0"
+    print("   ✓ Exact, normalized and fuzzy tiers matched; numbered stores never cross-matched")
+except Exception as e:
+    print(f"   ✗ Store-name lookup failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+print("\n26. Testing rule column projection...")
+original_folder = app_module.PARSE_CACHE_FOLDER
+cache_dir = tempfile.TemporaryDirectory()
+try:
+    app_module.PARSE_CACHE_FOLDER = cache_dir.name  # every load below parses
+    import json
+    from types import SimpleNamespace
+    from app import rule_source_columns, amex_source_columns, process_amex_file
+    mappings = {'StoreCode': 'Store Code', 'Amount': ' net amount '}
+    needed = rule_source_columns(mappings, ['StoreCode', 'Amount', 'BillDate'], extra=['Copy Col', None])
+    assert needed == {'STORE CODE', 'NET AMOUNT', 'BILLDATE', 'COPY COL'}, f"Unexpected columns {needed}"
+    upload = pd.DataFrame({'Store Code': ['S1', 'S2'], 'Junk': ['x', 'y'], 'Net Amount': ['10', '20'],
+                           'billdate': ['01-11-2025', '02-11-2025'], 'Copy Col': ['a', 'b'], 'Notes': ['n', 'm']})
+    for ext in ('csv', 'xlsx'):
+        buffer = io.BytesIO()
+        upload.to_csv(buffer, index=False) if ext == 'csv' else upload.to_excel(buffer, index=False)
+        df = load_file_smartly(MockFileStorage(buffer.getvalue(), f'upload.{ext}'), sheet_name=None, start_row=1,
+                               usecols=needed)
+        assert list(df.columns) == ['Store Code', 'Net Amount', 'billdate', 'Copy Col'], f"{ext}: {list(df.columns)}"
+        assert df['Net Amount'].tolist() == ['10', '20'], f"{ext}: projected values differ"
+
+    rule = SimpleNamespace(mappings=json.dumps({'Transaction Date': 'Txn Date', 'Store Code': 'Ignored',
+                                                'Bank Name': 'Amex'}))
+    amex = pd.DataFrame({'TXN DATE': ['01-11-2025'], 'SETTLEMENT DATE': ['03-11-2025'], 'STORE CODE': ['BP1001'],
+                         'SUBMISSION AMOUNT': ['100'], 'SETTLEMENT AMOUNT': ['98'], 'MERCHANT SERVICE FEE': ['2'],
+                         'TAX AMOUNT': ['0.36'], 'SUBMITTING MERCHANT NUMBER': ['555'], 'CARD TYPE': ['Gold']})
+    columns = amex_source_columns(rule)
+    assert columns == set(amex.columns) - {'CARD TYPE'}, f"Unexpected AMEX columns {columns}"
+    buffer = io.BytesIO()
+    amex.to_excel(buffer, index=False)
+    projected = load_file_smartly(MockFileStorage(buffer.getvalue(), 'amex.xlsx'), sheet_name=None, start_row=1,
+                                  usecols=columns)
+    assert 'CARD TYPE' not in projected.columns, "Unmapped AMEX column was read"
+    pd.testing.assert_frame_equal(process_amex_file(projected, rule), process_amex_file(amex, rule))
+    print("   ✓ Unmapped columns dropped; every column a rule reads kept, AMEX output unchanged")
+except Exception as e:
+    print(f"   ✗ Rule column projection failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+finally:
+    app_module.PARSE_CACHE_FOLDER = original_folder
+    cache_dir.cleanup()
+
+print("\n27. Testing Excel reader fallback when calamine fails...")
+try:
+    import app as app_module
+    from app import excel_engines_for, open_excel, read_excel_sheet
+    if not app_module.FAST_EXCEL_ENGINE_AVAILABLE:
+        print("   ⚠ python-calamine not installed, skipping fallback test")
+    else:
+        from pandas.io.excel._calamine import CalamineReader
+        assert excel_engines_for('xlsx') == ['calamine', 'openpyxl'], excel_engines_for('xlsx')
+        assert excel_engines_for('xls') == ['calamine', 'xlrd'], excel_engines_for('xls')
+        workbook = MockFileStorage(xlsx_bytes.getvalue(), 'fallback.xlsx')
+        expected = pd.read_excel(io.BytesIO(xlsx_bytes.getvalue()), engine='openpyxl', dtype=str)
+
+        def broken_workbook(self, *args, **kwargs):
+            raise RuntimeError("calamine could not parse the workbook")
+        original_load = CalamineReader.load_workbook
+        CalamineReader.load_workbook = broken_workbook
+        try:
+            book = open_excel(workbook)
+            assert book.engine == 'openpyxl', f"Opened with {book.engine}"
+            assert book.sheet_names == ['Sheet'], book.sheet_names
+            book.close()
+            df = read_excel_sheet(workbook, dtype=str)
+        finally:
+            CalamineReader.load_workbook = original_load
+        pd.testing.assert_frame_equal(df, expected)
+        pd.testing.assert_frame_equal(read_excel_sheet(workbook, dtype=str), expected)
+        print("   ✓ Failing calamine falls back to openpyxl with the same result")
+except Exception as e:
+    print(f"   ✗ Excel reader fallback failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+print("\n28. Testing spooled uploads...")
+original_folder, original_load = app_module.PARSE_CACHE_FOLDER, app_module.load_file_smartly
+cache_dir = tempfile.TemporaryDirectory()
+try:
+    app_module.PARSE_CACHE_FOLDER = cache_dir.name  # both uploads are parsed, not served from the cache
+    from app import upload_path
+
+    # Record what the parser gets from a real upload route (the split route loads CSVs
+    # with load_file_smartly)
+    seen = []
+    def recording_load(file, *args, **kwargs):
+        path = upload_path(file)
+        df = original_load(file, *args, **kwargs)
+        seen.append((path, bool(path and os.path.isfile(path)), len(df)))
+        return df
+    app_module.load_file_smartly = recording_load
+    flask_app.config['LOGIN_DISABLED'] = True
+    client = flask_app.test_client()
+    rows = ['Store Code,AMVIAK SPOC,Amount'] + [f'S{i:05d},Spoc {i % 3},{i}' for i in range(30000)]
+    big_csv = '\n'.join(rows).encode('utf-8')
+    assert len(big_csv) > app_module.UPLOAD_SPOOL_MIN_BYTES, "Large upload fixture below the spool threshold"
+
+    response = client.post('/process-split-file', data={'split_file': (io.BytesIO(big_csv), 'big.csv'), 'split_mode': 'csv'})
+    assert response.status_code == 200, response.get_data()[:200]
+    response.get_data()
+    path, on_disk, parsed_rows = seen[-1]
+    assert on_disk and parsed_rows == 30000, seen[-1]
+    assert os.path.dirname(os.path.abspath(path)) == os.path.abspath(app_module.UPLOAD_SPOOL_FOLDER), path
+    assert path.endswith('.csv'), "Spooled file lost its extension"
+    assert not os.path.exists(path), "Spooled upload left behind after the request"
+
+    small_csv = b'Store Code,AMVIAK SPOC,Amount\nS1,Spoc 1,1\nS2,Spoc 2,2\n'
+    response = client.post('/process-split-file', data={'split_file': (io.BytesIO(small_csv), 'small.csv'), 'split_mode': 'csv'})
+    assert response.status_code == 200, response.get_data()[:200]
+    assert seen[-1] == (None, False, 2), f"Small upload not kept in memory: {seen[-1]}"
+    print("   ✓ Large uploads parsed from a temp file removed after the request; small ones stay in memory")
+except Exception as e:
+    print(f"   ✗ Spooled uploads failed: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+finally:
+    app_module.PARSE_CACHE_FOLDER, app_module.load_file_smartly = original_folder, original_load
+    flask_app.config['LOGIN_DISABLED'] = False
+    cache_dir.cleanup()
+
 print("\n" + "=" * 70)
 print("✓ FILE LOADING TESTS PASSED!")
 print("=" * 70)